@@ -0,0 +1,192 @@
+"""Fast, low-precision, vectorized Moon and Sun positions for computing the
+Moon-object separation and Moon phase over whole ephemerides at once.
+
+The lunar position uses the largest periodic terms of the theory in Meeus,
+"Astronomical Algorithms" (2nd ed.) ch. 47 and the solar position the low
+precision formulae of ch. 25. Separations agree with astropy to ~1.5 arcmin
+and phases to 3e-4 over 1980-2060, which is ample for Moon avoidance.
+"""
+from numpy import arccos, arcsin, arctan2, array, asarray, clip, cos, radians, rad2deg, sin
+
+# Periodic terms for the Moon's longitude (1e-6 deg) and distance (1e-3 km):
+# multiples of D, M, M', F followed by the sine and cosine coefficients
+_LON_DIST_TERMS = array([
+    (0, 0, 1, 0, 6288774, -20905355),
+    (2, 0, -1, 0, 1274027, -3699111),
+    (2, 0, 0, 0, 658314, -2955968),
+    (0, 0, 2, 0, 213618, -569925),
+    (0, 1, 0, 0, -185116, 48888),
+    (0, 0, 0, 2, -114332, -3149),
+    (2, 0, -2, 0, 58793, 246158),
+    (2, -1, -1, 0, 57066, -152138),
+    (2, 0, 1, 0, 53322, -170733),
+    (2, -1, 0, 0, 45758, -204586),
+    (0, 1, -1, 0, -40923, -129620),
+    (1, 0, 0, 0, -34720, 108743),
+    (0, 1, 1, 0, -30383, 104755),
+    (2, 0, 0, -2, 15327, 10321),
+    (0, 0, 1, 2, -12528, 0),
+    (0, 0, 1, -2, 10980, 79661),
+    (4, 0, -1, 0, 10675, -34782),
+    (0, 0, 3, 0, 10034, -23210),
+    (4, 0, -2, 0, 8548, -21636),
+    (2, 1, -1, 0, -7888, 24208),
+    (2, 1, 0, 0, -6766, 30824),
+    (1, 0, -1, 0, -5163, -8379),
+    (1, 1, 0, 0, 4987, -16675),
+    (2, -1, 1, 0, 4036, -12831),
+    (2, 0, 2, 0, 3994, -10445),
+    (4, 0, 0, 0, 3861, -11650),
+    (2, 0, -3, 0, 3665, 14403),
+    (0, 1, -2, 0, -2689, -7003),
+    (2, 0, -1, 2, -2602, 0),
+    (2, -1, -2, 0, 2390, 10056),
+    (1, 0, 1, 0, -2348, 6322),
+    (2, -2, 0, 0, 2236, -9884),
+], dtype=float)
+
+# Periodic terms for the Moon's latitude (1e-6 deg): multiples of D, M, M', F
+# followed by the sine coefficient
+_LAT_TERMS = array([
+    (0, 0, 0, 1, 5128122),
+    (0, 0, 1, 1, 280602),
+    (0, 0, 1, -1, 277693),
+    (2, 0, 0, -1, 173237),
+    (2, 0, -1, 1, 55413),
+    (2, 0, -1, -1, 46271),
+    (2, 0, 0, 1, 32573),
+    (0, 0, 2, 1, 17198),
+    (2, 0, 1, -1, 9266),
+    (0, 0, 2, -1, 8822),
+    (2, -1, 0, -1, 8216),
+    (2, 0, -2, -1, 4324),
+    (2, 0, 1, 1, 4200),
+    (2, 1, 0, -1, -3359),
+    (2, -1, -1, 1, 2463),
+    (2, -1, 0, 1, 2211),
+    (2, -1, -1, -1, 2065),
+    (0, 1, -1, -1, -1870),
+    (4, 0, -1, -1, 1828),
+    (0, 1, 0, 1, -1794),
+], dtype=float)
+
+# Mean obliquity of the ecliptic at J2000 (radians) and Earth's equatorial radius (km)
+_OBLIQUITY_J2000 = radians(23.4392911)
+_EARTH_RADIUS = 6378.14
+
+
+def _centuries(jd):
+    """Returns Julian centuries since J2000 for the JD(s) <jd>"""
+
+    return (asarray(jd, dtype=float) - 2451545.0) / 36525.0
+
+
+def _ecliptic_to_equatorial(lon, lat):
+    """Converts J2000 ecliptic <lon>, <lat> (radians) to RA, Dec (radians)"""
+
+    sin_eps = sin(_OBLIQUITY_J2000)
+    cos_eps = cos(_OBLIQUITY_J2000)
+    ra = arctan2(sin(lon) * cos_eps - (sin(lat) / cos(lat)) * sin_eps, cos(lon))
+    dec = arcsin(sin(lat) * cos_eps + cos(lat) * sin_eps * sin(lon))
+
+    return ra, dec
+
+
+def moon_position(jd):
+    """Returns the geocentric J2000 RA, Dec (radians) and distance (km) of the
+    Moon at the (UTC) JD(s) <jd>"""
+
+    t = _centuries(jd)
+    mean_lon = 218.3164477 + t * (481267.88123421 + t * (-0.0015786 + t * (1.0 / 538841.0 - t / 65194000.0)))
+    elong = 297.8501921 + t * (445267.1114034 + t * (-0.0018819 + t * (1.0 / 545868.0 - t / 113065000.0)))
+    sun_anom = 357.5291092 + t * (35999.0502909 + t * (-0.0001536 + t / 24490000.0))
+    moon_anom = 134.9633964 + t * (477198.8675055 + t * (0.0087414 + t * (1.0 / 69699.0 - t / 14712000.0)))
+    arg_lat = 93.2720950 + t * (483202.0175233 + t * (-0.0036539 + t * (-1.0 / 3526000.0 + t / 863310000.0)))
+    a1 = radians(119.75 + 131.849 * t)
+    a2 = radians(53.09 + 479264.290 * t)
+    a3 = radians(313.45 + 481266.484 * t)
+    ecc = 1.0 - t * (0.002516 + 0.0000074 * t)
+
+    # Arguments of every term at once: shape (..., nterms)
+    args = radians(asarray([elong, sun_anom, moon_anom, arg_lat]))
+
+    def term_args(terms):
+        return sum(args[i][..., None] * terms[:, i] for i in range(4))
+
+    # Terms containing the Sun's mean anomaly are scaled by E (or E**2)
+    lon_ecc = ecc[..., None] ** abs(_LON_DIST_TERMS[:, 1])
+    lat_ecc = ecc[..., None] ** abs(_LAT_TERMS[:, 1])
+    lon_args = term_args(_LON_DIST_TERMS)
+    sum_l = (lon_ecc * _LON_DIST_TERMS[:, 4] * sin(lon_args)).sum(axis=-1)
+    sum_r = (lon_ecc * _LON_DIST_TERMS[:, 5] * cos(lon_args)).sum(axis=-1)
+    sum_b = (lat_ecc * _LAT_TERMS[:, 4] * sin(term_args(_LAT_TERMS))).sum(axis=-1)
+
+    mean_lon_rad = radians(mean_lon)
+    arg_lat_rad = radians(arg_lat)
+    moon_anom_rad = radians(moon_anom)
+    sum_l += 3958.0 * sin(a1) + 1962.0 * sin(mean_lon_rad - arg_lat_rad) + 318.0 * sin(a2)
+    sum_b += -2235.0 * sin(mean_lon_rad) + 382.0 * sin(a3) + 175.0 * sin(a1 - arg_lat_rad) \
+        + 175.0 * sin(a1 + arg_lat_rad) + 127.0 * sin(mean_lon_rad - moon_anom_rad) \
+        - 115.0 * sin(mean_lon_rad + moon_anom_rad)
+
+    # Longitude is referred to the equinox of date; remove the general
+    # precession in longitude to get back to J2000
+    lon = radians(mean_lon + sum_l / 1e6 - 1.3969713 * t)
+    lat = radians(sum_b / 1e6)
+    ra, dec = _ecliptic_to_equatorial(lon, lat)
+    distance = 385000.56 + sum_r / 1000.0
+
+    return ra, dec, distance
+
+
+def sun_position(jd):
+    """Returns the geocentric J2000 RA, Dec (radians) of the Sun at the (UTC)
+    JD(s) <jd>"""
+
+    t = _centuries(jd)
+    mean_lon = 280.46646 + t * (36000.76983 + 0.0003032 * t)
+    mean_anom = radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+    centre = (1.914602 - t * (0.004817 + 0.000014 * t)) * sin(mean_anom) \
+        + (0.019993 - 0.000101 * t) * sin(2.0 * mean_anom) + 0.000289 * sin(3.0 * mean_anom)
+    lon = radians(mean_lon + centre - 1.3969713 * t)
+
+    return _ecliptic_to_equatorial(lon, 0.0 * lon)
+
+
+def _angular_sep(ra1, dec1, ra2, dec2):
+    """Returns the angular separation (radians) between two (arrays of) positions"""
+
+    cos_sep = sin(dec1) * sin(dec2) + cos(dec1) * cos(dec2) * cos(ra1 - ra2)
+
+    return arccos(clip(cos_sep, -1.0, 1.0))
+
+
+def moon_sep_phase(jd, ra, dec, lon=None, lat=None):
+    """Calculates the separation (in degrees) between the Moon and an object at
+    J2000 <ra>, <dec> (in radians) and the illuminated fraction of the Moon (0..1)
+    at the (UTC) JD(s) <jd>. If the observer's East longitude [lon] and latitude
+    [lat] (in radians) are given, the Moon's position is corrected for parallax
+    to be topocentric, otherwise it is geocentric.
+    All arguments can be arrays; returns a tuple of (moon_sep, moon_phase) arrays"""
+
+    jd = asarray(jd, dtype=float)
+    moon_ra, moon_dec, moon_dist = moon_position(jd)
+    sun_ra, sun_dec = sun_position(jd)
+    # Illuminated fraction from the Sun-Earth-Moon elongation
+    moon_phase = (1.0 - cos(_angular_sep(moon_ra, moon_dec, sun_ra, sun_dec))) / 2.0
+
+    if lon is not None and lat is not None:
+        # Greenwich mean sidereal time (Meeus eq. 12.4) -> local sidereal time
+        t = _centuries(jd)
+        gmst = 280.46061837 + 360.98564736629 * (jd - 2451545.0) + t * t * (0.000387933 - t / 38710000.0)
+        lst = radians(gmst) + lon
+        # Subtract the observer's geocentric position from the Moon's
+        x = moon_dist * cos(moon_dec) * cos(moon_ra) - _EARTH_RADIUS * cos(lat) * cos(lst)
+        y = moon_dist * cos(moon_dec) * sin(moon_ra) - _EARTH_RADIUS * cos(lat) * sin(lst)
+        z = moon_dist * sin(moon_dec) - _EARTH_RADIUS * sin(lat)
+        moon_ra = arctan2(y, x)
+        moon_dec = arctan2(z, (x * x + y * y) ** 0.5)
+
+    moon_sep = rad2deg(_angular_sep(moon_ra, moon_dec, ra, dec))
+
+    return moon_sep, moon_phase
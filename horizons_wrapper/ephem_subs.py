@@ -1,18 +1,88 @@
+import functools
+import hashlib
 import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, time
-from math import cos, degrees, radians
+from math import degrees, radians, sin
 
-from numpy import sqrt as np_sqrt
-from astropy.time import Time
-from astropy.table import Column
+from numpy import abs as np_abs, argmin, around as np_around, arange, array as np_array, asarray, cos as np_cos, \
+    cumsum, datetime64, diff as np_diff, empty as np_empty, flatnonzero, floor as np_floor, hypot as np_hypot, \
+    isnan as np_isnan, ma as np_ma, median as np_median, nan, radians as np_radians, searchsorted, \
+    zeros as np_zeros
+from astropy import units as u
+from astropy.coordinates import SkyCoord, get_body, get_sun
+from astropy.time import Time, TimeDelta
+from astropy.table import Table
 from astroquery.jplhorizons import Horizons
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError, RequestException
+from urllib3.util.retry import Retry
+
+from ._moon import moon_sep_phase
 try:
-    import pyslalib.slalib as S
-except:
-    pass
+    from scipy.interpolate import CubicSpline
+except ImportError:
+    CubicSpline = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'horizons_wrapper')
+# Number of retries (with exponential backoff) when HORIZONS rate-limits us
+MAX_RATELIMIT_RETRIES = 5
+# Number of kept-alive connections to HORIZONS shared between queries
+HTTP_POOL_SIZE = 16
+# Above this many rows, the fast low-precision Moon code is used instead of astropy's
+MOON_KERNEL_MIN_ROWS = 100
+
+# requests Session shared by all HORIZONS queries (see `_horizons_session()`)
+_session = None
+_session_lock = threading.Lock()
+
+# Lines of the HORIZONS multiple-match list: record id, epoch year and 3+ more columns
+_HORIZONS_ID_LINE = re.compile(r'^\s*(\d+)\s+(\d{4})(?:\s+\S+){3}')
+
+# HORIZONS step sizes ('<n><units>') and the timedelta argument of each unit
+_STEP_SIZE = re.compile(r'^\s*(\d+)\s*([a-z]+)\s*$', re.IGNORECASE)
+_STEP_UNITS = {'m' : 'minutes', 'min' : 'minutes', 'mins' : 'minutes', 'minute' : 'minutes', 'minutes' : 'minutes',
+               'h' : 'hours', 'hr' : 'hours', 'hrs' : 'hours', 'hour' : 'hours', 'hours' : 'hours',
+               'd' : 'days', 'day' : 'days', 'days' : 'days'}
+
+# Columns that wrap around, with the lower bound and period of their range
+_WRAPPED_COLUMNS = {'RA' : (0.0, 360.0), 'AZ' : (0.0, 360.0), 'hour_angle' : (-12.0, 24.0)}
 
+# Month abbreviations used in the HORIZONS 'datetime_str' column
+_MONTHS = {'Jan' : 1, 'Feb' : 2, 'Mar' : 3, 'Apr' : 4, 'May' : 5, 'Jun' : 6,
+           'Jul' : 7, 'Aug' : 8, 'Sep' : 9, 'Oct' : 10, 'Nov' : 11, 'Dec' : 12}
 
-def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_limit=0, quantities='1,3,4,9,19,20,23,24,38,42', include_moon=False):
+# Table columns produced by each HORIZONS quantity code
+_QUANTITY_COLUMNS = {'1' : ('RA', 'DEC'), '2' : ('RA_app', 'DEC_app'), '3' : ('RA_rate', 'DEC_rate'),
+                     '4' : ('AZ', 'EL'), '8' : ('airmass', 'magextinct'), '9' : ('V', 'surfbright', 'Tmag', 'Nmag'),
+                     '19' : ('r', 'r_rate'), '20' : ('delta', 'delta_rate'), '23' : ('elong', 'elongFlag'),
+                     '24' : ('alpha',), '38' : ('RSS_3sigma',), '42' : ('hour_angle',)}
+_COLUMN_QUANTITY = dict((column, code) for code, columns in _QUANTITY_COLUMNS.items() for column in columns)
+# Columns which are always returned (or computed) regardless of the quantities
+_ALWAYS_COLUMNS = ('targetname', 'datetime_str', 'datetime_jd', 'H', 'G', 'M1', 'M2', 'k1', 'k2', 'phasecoeff',
+                   'solar_presence', 'lunar_presence', 'interfering_body', 'flags', 'datetime', 'mean_rate')
+# Columns computed locally (with include_moon) from the object's RA/Dec
+_MOON_COLUMNS = ('moon_sep', 'moon_phase')
+
+# Negative HA, positive HA and altitude mount limits (in degrees) of the LCOGT
+# telescopes, keyed by MPC site code
+_1M0_LIMITS = (-4.5 * 15.0, 4.5 * 15.0, 30.0)
+_0M4_LIMITS = (-4.5 * 15.0, 4.46 * 15.0, 15.0)
+_DEFAULT_LIMITS = (-12.0 * 15.0, 12.0 * 15.0, 25.0)
+_SITE_LIMITS = dict([(site, _1M0_LIMITS) for site in ('V37', 'V39', 'W85', 'W86', 'W87', 'K91', 'K92', 'K93', 'Q63', 'Q64')] +
+                    [(site, _0M4_LIMITS) for site in ('Z17', 'Z21', 'Q58', 'Q59', 'T03', 'T04', 'W89', 'W79', 'V38', 'L09')])
+# Substrings of telescope designations (e.g. 'ELP-DOMA-1M0A') and their limits, checked in order
+_SITE_DESIGNATION_RULES = (('-1M0A', _1M0_LIMITS), ('-AQWA', _0M4_LIMITS), ('-AQWB', _0M4_LIMITS), ('CLMA-0M4', _0M4_LIMITS))
+
+
+def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_limit=0, quantities='1,3,4,9,19,20,23,24,38,42', include_moon=False, cache_ttl=None, interp_step=None, required_cols=None, return_as='table'):
     """Calls JPL HORIZONS for the specified <obj_name> producing an ephemeris
     from <start> (datetime) to <end> (datetime) for the MPC site code <site_code> with step size
     of [ephem_step_size] (defaults to '1h').
@@ -44,7 +114,27 @@ def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_li
      'datetime']
     If [include_moon] = True, 2 additional columns of the Moon-Object separation
     ('moon_sep'; in degrees) and the Moon phase ('moon_phase'; 0..1) are added
-    to the table.
+    to the table. These come from astropy for up to MOON_KERNEL_MIN_ROWS rows and
+    from the much faster low-precision Moon code in `_moon` for longer tables,
+    which agrees with astropy to ~1.5 arcmin in separation and 3e-4 in phase
+    (measured over 1980-2060).
+    If [required_cols] (a sequence of column names e.g. ('RA', 'DEC', 'V')) is
+    given, it replaces [quantities] with the smallest set of HORIZONS quantities
+    that produces those columns (plus the RA/Dec rates, which are always needed),
+    which shrinks the response that has to be transferred and parsed. Asking
+    for 'moon_sep' or 'moon_phase' implies [include_moon].
+    If [cache_ttl] (a timedelta) is given, the raw HORIZONS response is cached
+    on disk in CACHE_DIR and re-used for identical queries made within [cache_ttl]
+    instead of contacting HORIZONS again. The HORIZONS id chosen for an ambiguous
+    <obj_name> (e.g. a periodic comet) is cached too, so repeat queries go
+    straight to the id.
+    If [interp_step] (e.g. '10m') is given, HORIZONS is queried at that coarser
+    step size and the results are interpolated onto the [ephem_step_size] grid
+    locally (see `interpolate_horizons_table()`; requires scipy), which reduces
+    the amount of data fetched and parsed for fine step sizes.
+    If [return_as] = 'numpy', a dict of numpy arrays keyed by column name is
+    returned instead of an Astropy Table (see `horizons_table_to_arrays()`); this
+    skips building the Table, Columns and Time objects but does not keep units.
     The returned quantities are described in the HORIZONS docs: https://ssd.jpl.nasa.gov/?horizons_doc#specific_quantities
     and are summarized below
     1.  Astrometric RA & DEC            17. North Pole position angle & distance 33. Galactic longitude & latitude
@@ -65,84 +155,454 @@ def horizons_ephem(obj_name, start, end, site_code, ephem_step_size='1h', alt_li
     16. Sub-Sun position angle & distance 32. North pole RA & DEC              
     """
 
-    eph = Horizons(id=obj_name, id_type='smallbody', epochs={'start' : start.strftime("%Y-%m-%d %H:%M"),
-            'stop' : end.strftime("%Y-%m-%d %H:%M"), 'step' : ephem_step_size}, location=site_code)
-
-    airmass_limit = 99
-    if alt_limit > 0:
-        airmass_limit = 1.0/cos(radians(90.0 - alt_limit))
-
-    ha_lowlimit, ha_hilimit, alt_limit = get_mountlimits(site_code)
-    ha_limit = max(abs(ha_lowlimit), abs(ha_hilimit)) / 15.0
-    should_skip_daylight = True
+    if return_as not in ('table', 'numpy'):
+        raise ValueError("return_as must be 'table' or 'numpy', not {}".format(return_as))
+    airmass_limit, ha_limit, should_skip_daylight = _site_constraints(site_code, alt_limit)
 
+    if required_cols is not None:
+        if any(colname in _MOON_COLUMNS for colname in required_cols):
+            include_moon = True
+        if include_moon:
+            required_cols = tuple(required_cols) + ('RA', 'DEC')
+        quantities = quantities_for_columns(required_cols)
     # Need Ra/Dec rate at least
-    if '3,' not in quantities:
-        quantities += ',3'
-    
-    if len(site_code) >= 1 and site_code[0] == '-':
-        # Radar site
-        should_skip_daylight = False
+    codes = [code.strip() for code in quantities.split(',') if code.strip()]
+    if '3' not in codes:
+        quantities = ','.join(codes + ['3'])
+
+    query_step = ephem_step_size
+    query_end = end
+    if interp_step:
+        # Check the fine step size is usable before querying anything
+        _step_to_timedelta(ephem_step_size)
+        # Query one extra coarse step so the end of the fine grid is covered
+        query_step = interp_step
+        query_end = end + _step_to_timedelta(interp_step)
+    # Format the times once; used for both queries and the cache key
+    start_str = start.strftime("%Y-%m-%d %H:%M:%S")
+    end_str = query_end.strftime("%Y-%m-%d %H:%M:%S")
+    ephem = None
+    horizons_id = None
+    if cache_ttl is not None:
+        horizons_id = _cached_horizons_id(obj_name, cache_ttl)
     try:
-        ephem = eph.ephemerides(quantities=quantities,
-            skip_daylight=should_skip_daylight, airmass_lessthan=airmass_limit,
-            max_hour_angle=ha_limit)
-        ephem = convert_horizons_table(ephem, include_moon)
-    except ConnectionError as e:
+        if horizons_id:
+            ephem = _cached_ephemerides(horizons_id, 'id', start_str, end_str, query_step, site_code, quantities,
+                should_skip_daylight, airmass_limit, ha_limit, cache_ttl)
+        else:
+            ephem = _cached_ephemerides(obj_name, 'smallbody', start_str, end_str, query_step, site_code, quantities,
+                should_skip_daylight, airmass_limit, ha_limit, cache_ttl)
+    except (ConnectionError, RequestsConnectionError) as e:
         logger.error("Unable to connect to HORIZONS")
+    except RequestException as e:
+        # e.g. HTTP errors (such as a 429 still failing after retries) or timeouts
+        logger.error("Error querying HORIZONS. Error message: {}".format(e))
     except ValueError as e:
         logger.debug("Ambiguous object, trying to determine HORIZONS id")
-        ephem = None
         if e.args and len(e.args) > 0:
             choices = e.args[0].split('\n')
             horizons_id = determine_horizons_id(choices)
-            logger.debug("HORIZONS id=", horizons_id)
+            logger.debug("HORIZONS id={}".format(horizons_id))
             if horizons_id:
+                if cache_ttl is not None:
+                    _write_cache_file(_cache_filename('horizons_id', obj_name), Table({'horizons_id': [horizons_id]}))
                 try:
-                    eph = Horizons(id=horizons_id, id_type='id', epochs={'start' : start.strftime("%Y-%m-%d %H:%M:%S"),
-                        'stop' : end.strftime("%Y-%m-%d %H:%M:%S"), 'step' : ephem_step_size}, location=site_code)
-                    ephem = eph.ephemerides(quantities=quantities,
-                        skip_daylight=should_skip_daylight, airmass_lessthan=airmass_limit,
-                        max_hour_angle=ha_limit)
-                    ephem = convert_horizons_table(ephem, include_moon)
-                except ValueError as e:
+                    ephem = _cached_ephemerides(horizons_id, 'id', start_str, end_str, query_step, site_code, quantities,
+                        should_skip_daylight, airmass_limit, ha_limit, cache_ttl)
+                except (ValueError, RequestException) as e:
                     logger.warning("Error querying HORIZONS. Error message: {}".format(e))
             else:
                 logger.warning("Unable to determine the HORIZONS id")
         else:
             logger.warning("Error querying HORIZONS. Error message: {}".format(e))
+    if ephem is None:
+        return None
+
+    # Post-processing errors are not query errors so are left to propagate
+    if interp_step:
+        ephem = interpolate_horizons_table(ephem, start, end, ephem_step_size)
+    if return_as == 'numpy':
+        ephem = horizons_table_to_arrays(ephem, required_cols, include_moon)
+    else:
+        ephem = convert_horizons_table(ephem, include_moon)
     return ephem
 
 
+def horizons_ephem_many(obj_names, start, end, site_code, max_workers=8, **kwargs):
+    """Calls `horizons_ephem()` for each of the objects in <obj_names>, producing
+    ephemerides from <start> (datetime) to <end> (datetime) for the MPC site
+    code <site_code>. The HORIZONS queries are made concurrently using up to
+    [max_workers] threads (they are I/O-bound so threads are sufficient); any
+    other keyword arguments are passed through to `horizons_ephem()`.
+    Returns a dict keyed by object name of whatever `horizons_ephem()` returned
+    for each object: an Astropy Table, a dict of numpy arrays (with
+    return_as='numpy') or None if the query failed."""
+
+    obj_names = list(obj_names)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = executor.map(lambda obj_name: horizons_ephem(obj_name, start, end, site_code, **kwargs), obj_names)
+        ephems = dict(zip(obj_names, tables))
+    return ephems
+
+
+def quantities_for_columns(colnames):
+    """Returns the smallest comma-separated string of HORIZONS quantity codes
+    that will produce the table columns in <colnames>. Raises ValueError for
+    columns that it doesn't know how to request."""
+
+    codes = set()
+    for colname in colnames:
+        if colname in _ALWAYS_COLUMNS:
+            continue
+        if colname in _MOON_COLUMNS:
+            # Computed from the object's RA/Dec
+            codes.add('1')
+            continue
+        try:
+            codes.add(_COLUMN_QUANTITY[colname])
+        except KeyError:
+            raise ValueError("Don't know which HORIZONS quantity produces column '{}'".format(colname))
+
+    return ','.join(sorted(codes, key=int))
+
+
+def _cached_ephemerides(obj_id, id_type, start_str, end_str, step, site_code, quantities,
+        skip_daylight, airmass_lessthan, max_hour_angle, cache_ttl=None):
+    """Queries HORIZONS for <obj_id> (of type <id_type>) from <start_str> to
+    <end_str> with step size <step> for the MPC site code <site_code>,
+    returning the raw (unconverted) Astropy Table from `ephemerides()`.
+    If [cache_ttl] (a timedelta) is given, the table is stored in CACHE_DIR
+    keyed on all of the query arguments and is read back from there (without
+    contacting HORIZONS) until the cached copy is older than [cache_ttl]."""
+
+    cache_file = None
+    if cache_ttl is not None:
+        cache_file = _cache_filename(str(obj_id), id_type, start_str, end_str, step, site_code, quantities,
+            skip_daylight, airmass_lessthan, max_hour_angle)
+        cached = _read_cache_file(cache_file, cache_ttl)
+        if cached is not None:
+            return cached
+
+    eph = Horizons(id=obj_id, id_type=id_type, epochs={'start' : start_str,
+            'stop' : end_str, 'step' : step}, location=site_code)
+    eph._session = _horizons_session(eph._session)
+    # Don't let astroquery write the response to its own cache and re-read it;
+    # caching (if wanted) is done here on the parsed table
+    ephem = eph.ephemerides(quantities=quantities,
+        skip_daylight=skip_daylight, airmass_lessthan=airmass_lessthan,
+        max_hour_angle=max_hour_angle, cache=False)
+
+    if cache_file is not None:
+        _write_cache_file(cache_file, ephem)
+    return ephem
+
+
+def _cached_horizons_id(obj_name, cache_ttl):
+    """Returns the HORIZONS id previously chosen for the ambiguous <obj_name>
+    if it was cached within <cache_ttl>, otherwise None"""
+
+    cached = _read_cache_file(_cache_filename('horizons_id', obj_name), cache_ttl)
+    if cached is None or len(cached) == 0:
+        return None
+    horizons_id = int(cached['horizons_id'][0])
+    logger.debug("Using cached HORIZONS id={} for {}".format(horizons_id, obj_name))
+    return horizons_id
+
+
+def _cache_filename(*key):
+    """Returns the path of the file in CACHE_DIR for the cache <key> values"""
+
+    return os.path.join(CACHE_DIR, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.ecsv')
+
+
+def _read_cache_file(cache_file, cache_ttl):
+    """Returns the Table cached in <cache_file> if it exists and is no older
+    than <cache_ttl>, otherwise None. A cache file that can't be read back is
+    deleted so that the next query replaces it."""
+
+    try:
+        age = datetime.now().timestamp() - os.path.getmtime(cache_file)
+    except OSError:
+        return None
+    if age > cache_ttl.total_seconds():
+        return None
+
+    try:
+        # ECSV only keeps masks for columns with masked values; make every
+        # column a MaskedColumn again, as in the tables astroquery returns
+        ephem = Table(Table.read(cache_file, format='ascii.ecsv'), masked=True)
+    except Exception as e:
+        logger.warning("Discarding unreadable HORIZONS cache file {}: {}".format(cache_file, e))
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+        return None
+    logger.debug("Using cached HORIZONS response from {}".format(cache_file))
+    return ephem
+
+
+def _write_cache_file(cache_file, ephem):
+    """Stores the Table <ephem> in <cache_file>. Failing to write the cache
+    is logged but otherwise ignored; the query result is still good."""
+
+    tmp_name = None
+    try:
+        # Write to a temporary file and rename so readers never see a partial file
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.ecsv', delete=False) as tmp_file:
+            tmp_name = tmp_file.name
+        ephem.write(tmp_name, format='ascii.ecsv', overwrite=True)
+        os.replace(tmp_name, cache_file)
+    except OSError as e:
+        logger.warning("Unable to write HORIZONS cache file {}: {}".format(cache_file, e))
+        if tmp_name is not None:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+
+
+def _horizons_session(template):
+    """Returns the requests Session shared by all HORIZONS queries, creating it
+    on first use with the headers and hooks of <template> (the Session of a
+    freshly made `Horizons` object). Sharing one Session keeps connections to
+    JPL alive between queries instead of doing a new TCP+TLS handshake each
+    time. Rate-limited (429) and unavailable (503) responses are retried up to
+    MAX_RATELIMIT_RETRIES times with exponential backoff by the adapter; if the
+    last retry still fails, that response is handed back and astroquery raises
+    an HTTPError, which `horizons_ephem()` logs before returning None."""
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = Session()
+            session.headers.update(template.headers)
+            session.hooks['response'] = list(template.hooks['response'])
+            retries = Retry(total=MAX_RATELIMIT_RETRIES, backoff_factor=1, status_forcelist=(429, 503),
+                raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+
+def interpolate_horizons_table(ephem, start, end, step_size):
+    """Interpolates the (coarse step size) Astropy Table <ephem> from
+    `astroquery.jplhorizons.ephemerides()` onto a finer grid from <start>
+    (datetime) to <end> (datetime) with a step of <step_size> (a HORIZONS step
+    size e.g. '1m'). Float columns are interpolated in JD with cubic splines
+    (after unwrapping RA, AZ and hour angle); other columns take the value of the
+    nearest coarse row and 'datetime_str' is regenerated. Fine grid points are
+    only produced within runs of consecutive coarse rows, so gaps from the
+    daylight/airmass/hour angle cuts are preserved (to within a coarse step).
+    A table of fewer than 2 rows can't be interpolated and is returned without
+    any rows after <end>.
+    Splines follow smoothly-moving objects well, but the coarse step needs to be
+    short compared with the timescale on which the motion changes (very close
+    approaches may need a fine coarse step, or no interpolation at all); this
+    accuracy has not been checked against HORIZONS for any particular step.
+    Requires scipy. Returns a new Astropy Table."""
+
+    if CubicSpline is None:
+        raise ImportError("scipy is needed to interpolate HORIZONS ephemerides")
+
+    tolerance = 1.0 / 86400.0
+    jd_coarse = asarray(ephem['datetime_jd'], dtype=float)
+    if len(jd_coarse) < 2:
+        # Drop the extra coarse row that `horizons_ephem()` asks for past <end>
+        return ephem[jd_coarse <= Time(end, scale='utc').jd + tolerance]
+
+    # Fine grid built from exact Time offsets to avoid accumulating JD roundoff
+    step = _step_to_timedelta(step_size)
+    num_steps = int((end - start) / step) + 1
+    fine_times = Time(start, scale='utc') + TimeDelta(arange(num_steps) * step.total_seconds(), format='sec')
+    jd_fine = fine_times.jd
+
+    # Find runs of consecutive coarse rows (breaking where rows were cut) and
+    # the fine grid points that lie within each one
+    gaps = flatnonzero(np_diff(jd_coarse) > 1.5 * np_median(np_diff(jd_coarse)))
+    segments = []
+    keep = np_zeros(len(jd_fine), dtype=bool)
+    for first, last in zip([0] + list(gaps + 1), list(gaps) + [len(jd_coarse) - 1]):
+        in_segment = (jd_fine >= jd_coarse[first] - tolerance) & (jd_fine <= jd_coarse[last] + tolerance)
+        segments.append((first, last, in_segment))
+        keep |= in_segment
+    segments = [(first, last, in_segment[keep]) for first, last, in_segment in segments]
+    fine_times = fine_times[keep]
+    jd_fine = jd_fine[keep]
+
+    # Start from the nearest coarse row to each fine point
+    nearest = searchsorted(jd_coarse, jd_fine).clip(1, len(jd_coarse) - 1)
+    nearest -= (jd_fine - jd_coarse[nearest - 1]) < (jd_coarse[nearest] - jd_fine)
+    interp_ephem = ephem[nearest]
+
+    for name in ephem.colnames:
+        if name == 'datetime_jd' or ephem[name].dtype.kind != 'f':
+            continue
+        values = np_ma.filled(ephem[name], nan).astype(float)
+        wrap = _WRAPPED_COLUMNS.get(name)
+        if wrap:
+            lower, period = wrap
+            # Unwrap by removing whole periods at each jump between the unmasked values
+            valid = ~np_isnan(values)
+            valid_values = values[valid]
+            valid_values[1:] -= period * cumsum(np_around(np_diff(valid_values) / period))
+            values[valid] = valid_values
+        interp_values = np_empty(len(jd_fine))
+        for first, last, in_segment in segments:
+            # Fit through the unmasked values only
+            valid = ~np_isnan(values[first:last+1])
+            if valid.sum() >= 2:
+                spline = CubicSpline(jd_coarse[first:last+1][valid], values[first:last+1][valid])
+                interp_values[in_segment] = spline(jd_fine[in_segment])
+            else:
+                interp_values[in_segment] = values[first]
+        if wrap:
+            interp_values = (interp_values - lower) % period + lower
+        interp_ephem[name][:] = interp_values
+        if hasattr(interp_ephem[name], 'mask'):
+            # Rows closest to a masked coarse value stay masked
+            interp_ephem[name].mask = np_isnan(interp_values) | np_isnan(values[nearest])
+
+    interp_ephem['datetime_jd'][:] = jd_fine
+    interp_ephem['datetime_str'][:] = fine_times.strftime("%Y-%b-%d %H:%M")
+
+    return interp_ephem
+
+
+def _step_to_timedelta(step_size):
+    """Converts a HORIZONS <step_size> of the form '<n><units>' (e.g. '10m',
+    '1h', '1d') into a timedelta. Raises ValueError for step sizes that are not
+    a fixed interval (e.g. '5' for 5 equal intervals, or month/year steps)"""
+
+    match = _STEP_SIZE.match(str(step_size))
+    units = _STEP_UNITS.get(match.group(2).lower()) if match else None
+    if units is None:
+        raise ValueError("Unsupported step size for interpolation: {}".format(step_size))
+
+    return timedelta(**{units : int(match.group(1))})
+
+
 def convert_horizons_table(ephem, include_moon=False):
     """Modifies a passed table <ephem> from the `astroquery.jplhorizons.ephemerides()
     to add a 'datetime' column, rate columns and adds moon phase and separation
-    columns (if [include_moon] is True).
+    columns (if [include_moon] is True). For tables longer than MOON_KERNEL_MIN_ROWS,
+    the Moon quantities come from the faster (~1.5 arcmin) `_moon.moon_sep_phase()`.
     The modified Astropy Table is returned"""
 
-    dates = Time([datetime.strptime(d, "%Y-%b-%d %H:%M") for d in ephem['datetime_str']])
+    # HORIZONS already gives the JD of each row so build the times from that
+    # rather than parsing 'datetime_str'. The day fraction is rounded to the
+    # nearest second to remove the float64 noise in the JD. Python datetimes
+    # are only produced (lazily, by astropy) if the column values are used.
+    if 'datetime_jd' in ephem.colnames:
+        jd = asarray(ephem['datetime_jd'], dtype=float)
+        jd1 = np_floor(jd)
+        jd2 = np_around((jd - jd1) * 86400.0) / 86400.0
+        dates = Time(jd1, jd2, format='jd', scale='utc')
+        dates.format = 'datetime'
+    else:
+        dates = Time(list(map(_parse_horizons_datetime, ephem['datetime_str'])), scale='utc')
     if 'datetime' not in ephem.colnames:
-        ephem.add_column(dates, name='datetime')
-    # Convert units of RA/Dec rate from arcsec/hr to arcsec/min and compute
-    # mean rate
-    ephem['RA_rate'].convert_unit_to('arcsec/min')
-    ephem['DEC_rate'].convert_unit_to('arcsec/min')
-    rate_units = ephem['DEC_rate'].unit
-    mean_rate = np_sqrt(ephem['RA_rate']**2 + ephem['DEC_rate']**2)
+        ephem['datetime'] = dates
+    # Convert units of RA/Dec rate from arcsec/hr to arcsec/min (scaling the
+    # values in place) and compute mean rate
+    rate_units = u.arcsec / u.min
+    for rate in (ephem['RA_rate'], ephem['DEC_rate']):
+        rate *= rate.unit.to(rate_units)
+        rate.unit = rate_units
+    mean_rate = np_hypot(ephem['RA_rate'], ephem['DEC_rate'])
     mean_rate.unit = rate_units
-    ephem.add_column(mean_rate, name='mean_rate')
+    ephem['mean_rate'] = mean_rate
     if include_moon is True:
-        moon_seps = []
-        moon_phases = []
-        for date, obj_ra, obj_dec in ephem[('datetime', 'RA', 'DEC')]:
-            moon_alt, moon_obj_sep, moon_phase = calc_moon_sep(date.datetime, radians(obj_ra), radians(obj_dec), '-1')
-            moon_seps.append(moon_obj_sep)
-            moon_phases.append(moon_phase)
-        ephem.add_columns(cols=(Column(moon_seps), Column(moon_phases)), names=('moon_sep', 'moon_phase'))
+        # Work on the plain arrays rather than iterating over Table rows
+        obj_ra = asarray(ephem['RA'])
+        obj_dec = asarray(ephem['DEC'])
+        if len(ephem) > MOON_KERNEL_MIN_ROWS:
+            jd = asarray(ephem['datetime_jd'])
+            moon_seps, moon_phases = moon_sep_phase(jd, np_radians(obj_ra), np_radians(obj_dec))
+        else:
+            moon_seps, moon_phases = calc_moon_sep_phase(ephem['datetime'], obj_ra, obj_dec)
+        ephem['moon_sep'] = moon_seps
+        ephem['moon_phase'] = moon_phases
 
     return ephem
 
 
+def horizons_table_to_arrays(ephem, colnames=None, include_moon=False):
+    """Converts a table <ephem> from `astroquery.jplhorizons.ephemerides()` into
+    a dict of numpy arrays keyed by column name, without building the extra
+    Astropy Columns and Time of `convert_horizons_table()`. Only the columns in
+    [colnames] (default all) that are in <ephem> are kept, plus 'datetime_jd' and
+    'mean_rate' and, if [include_moon] is True, 'moon_sep' and 'moon_phase'.
+    Times are only given as JDs ('datetime_jd'; there is no 'datetime').
+    As in `convert_horizons_table()`, 'RA_rate', 'DEC_rate' and 'mean_rate' are
+    in arcsec/min, but unit metadata is not kept. Masked numeric values are NaN;
+    integer columns with masked values (e.g. 'AZ' when HORIZONS gives 'n.a.' for
+    every row) are converted to float for this."""
+
+    if colnames is None:
+        colnames = ephem.colnames
+    colnames = [name for name in colnames if name in ephem.colnames]
+    colnames += [name for name in ('datetime_jd', 'RA_rate', 'DEC_rate') if name not in colnames]
+    if include_moon:
+        colnames += [name for name in ('RA', 'DEC') if name not in colnames]
+
+    arrays = {}
+    for name in colnames:
+        column = ephem[name]
+        if column.dtype.kind == 'f' or (column.dtype.kind in 'iu' and np_ma.is_masked(column)):
+            arrays[name] = np_ma.filled(np_ma.asarray(column, dtype=float), nan)
+        else:
+            arrays[name] = asarray(np_ma.filled(column))
+
+    rate_units = u.arcsec / u.min
+    for name in ('RA_rate', 'DEC_rate'):
+        arrays[name] *= ephem[name].unit.to(rate_units)
+    arrays['mean_rate'] = np_hypot(arrays['RA_rate'], arrays['DEC_rate'])
+    if include_moon is True:
+        jd = arrays['datetime_jd']
+        obj_ra = arrays['RA']
+        obj_dec = arrays['DEC']
+        if len(jd) > MOON_KERNEL_MIN_ROWS:
+            moon_seps, moon_phases = moon_sep_phase(jd, np_radians(obj_ra), np_radians(obj_dec))
+        else:
+            dates = Time(jd, format='jd', scale='utc')
+            moon_seps, moon_phases = calc_moon_sep_phase(dates, obj_ra, obj_dec)
+        arrays['moon_sep'] = asarray(moon_seps)
+        arrays['moon_phase'] = asarray(moon_phases)
+
+    return arrays
+
+
+def _parse_horizons_datetime(datetime_str):
+    """Parses a fixed-width HORIZONS <datetime_str> of the form
+    'YYYY-Mon-DD HH:MM' (optionally followed by ':SS') into a datetime.
+    This slices the string directly which is much faster than `strptime()`."""
+
+    second = int(datetime_str[18:20]) if len(datetime_str) >= 20 else 0
+    return datetime(int(datetime_str[0:4]), _MONTHS[datetime_str[5:8]], int(datetime_str[9:11]),
+        int(datetime_str[12:14]), int(datetime_str[15:17]), second)
+
+
+def calc_moon_sep_phase(dates, obj_ra, obj_dec):
+    """Calculates the geocentric separation (in degrees) between the Moon and an
+    object at <obj_ra>, <obj_dec> (in degrees) and the illuminated fraction of
+    the Moon (0..1) at the astropy Time(s) <dates>. All arguments can be arrays,
+    in which case everything is computed in one vectorized pass.
+    Returns a tuple of (moon_sep, moon_phase)"""
+
+    moon = get_body('moon', dates)
+    obj = SkyCoord(obj_ra, obj_dec, unit='deg').transform_to(moon.frame)
+    moon_sep = moon.separation(obj).deg
+    # Illuminated fraction from the Sun-Earth-Moon elongation
+    elongation = moon.separation(get_sun(dates))
+    moon_phase = (1.0 - np_cos(elongation.rad)) / 2.0
+
+    return moon_sep, moon_phase
+
+
 def determine_horizons_id(lines, now=None):
     """Attempts to determine the HORIZONS id of a target body that has multiple
     possibilities. The passed [lines] (from the .args attribute of the exception)
@@ -150,22 +610,40 @@ def determine_horizons_id(lines, now=None):
     which is closest to [now] (a passed-in datetime or defaulting to datetime.utcnow()"""
 
     now = now or datetime.utcnow()
-    timespan = timedelta.max
-    horizons_id = None
-    for line in lines:
-        chunks = line.split()
-        if len(chunks) >= 5 and chunks[0].isdigit() is True and chunks[1].isdigit() is True:
-            try:
-                epoch_yr = datetime.strptime(chunks[1], "%Y")
-                if abs(now-epoch_yr) <= timespan:
-                    # New closer match to "now"
-                    horizons_id = int(chunks[0])
-                    timespan = now-epoch_yr
-            except ValueError:
-                logger.warning("Unable to parse year of epoch from", line)
-    return horizons_id
+    matches = [tuple(map(int, match.groups())) for match in map(_HORIZONS_ID_LINE.match, lines) if match]
+    if not matches:
+        return None
+    horizons_ids, epoch_yrs = np_array(matches).T
+    # Time between [now] and the start of each epoch year. If several are
+    # equally close, the last one in the list wins.
+    timespans = np_abs(datetime64(now) - (epoch_yrs - 1970).astype('datetime64[Y]'))
+    closest = len(timespans) - 1 - argmin(timespans[::-1])
+
+    return int(horizons_ids[closest])
+
+
+@functools.lru_cache(maxsize=None)
+def _site_constraints(site_code, alt_limit=0):
+    """Returns the HORIZONS query constraints for the MPC site code <site_code>
+    as a tuple of (airmass_limit, ha_limit, should_skip_daylight): the airmass
+    at [alt_limit] (in degrees; 99 i.e. no limit unless [alt_limit] > 0), the
+    maximum hour angle (in hours) from the mount limits, and whether daylight
+    should be skipped (not for radar sites, whose codes start with '-').
+    These only depend on the arguments so are cached."""
+
+    airmass_limit = 99
+    if alt_limit > 0:
+        airmass_limit = 1.0/sin(radians(alt_limit))
+
+    ha_lowlimit, ha_hilimit, mount_alt_limit = get_mountlimits(site_code)
+    ha_limit = max(abs(ha_lowlimit), abs(ha_hilimit)) / 15.0
+    # Radar sites
+    should_skip_daylight = not site_code.startswith('-')
+
+    return airmass_limit, ha_limit, should_skip_daylight
 
 
+@functools.lru_cache(maxsize=None)
 def get_mountlimits(site_code_or_name):
     """Returns the negative, positive and altitude mount limits (in degrees)
     for the LCOGT telescopes specified by <site_code_or_name>.
@@ -174,17 +652,11 @@ def get_mountlimits(site_code_or_name):
     or by designation e.g. 'OGG-CLMA-2M0A' (=FTN)"""
 
     site = site_code_or_name.upper()
-    ha_pos_limit = 12.0 * 15.0
-    ha_neg_limit = -12.0 * 15.0
-    alt_limit = 25.0
-
-    if '-1M0A' in site or site in ['V37', 'V39', 'W85', 'W86', 'W87', 'K91', 'K92', 'K93', 'Q63', 'Q64']:
-        ha_pos_limit = 4.5 * 15.0
-        ha_neg_limit = -4.5 * 15.0
-        alt_limit = 30.0
-    elif '-AQWA' in site or '-AQWB' in site or 'CLMA-0M4' in site or site in ['Z17', 'Z21', 'Q58', 'Q59', 'T03', 'T04', 'W89', 'W79', 'V38', 'L09']:
-        ha_pos_limit = 4.46 * 15.0
-        ha_neg_limit = -4.5 * 15.0
-        alt_limit = 15.0
-
-    return ha_neg_limit, ha_pos_limit, alt_limit
+    limits = _SITE_LIMITS.get(site)
+    if limits is not None:
+        return limits
+    for designation, limits in _SITE_DESIGNATION_RULES:
+        if designation in site:
+            return limits
+
+    return _DEFAULT_LIMITS
@@ -0,0 +1,440 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.table import MaskedColumn, Table
+from astropy.time import Time
+from requests import Response, Session
+from requests.exceptions import ConnectionError as RequestsConnectionError, HTTPError, ReadTimeout
+
+from horizons_wrapper import ephem_subs
+from horizons_wrapper.ephem_subs import determine_horizons_id, get_mountlimits, horizons_ephem, \
+    horizons_ephem_many, interpolate_horizons_table, quantities_for_columns, _parse_horizons_datetime, \
+    _site_constraints, _step_to_timedelta
+
+
+def make_ephem(ra, step=timedelta(minutes=10), start=datetime(2020, 10, 19), mask=None):
+    """Builds a synthetic table shaped like the output of
+    `astroquery.jplhorizons.ephemerides()` with the RAs in <ra> (degrees) at
+    intervals of [step] from [start]; rows in [mask] have their RA and V masked."""
+
+    num_rows = len(ra)
+    times = Time(start, scale='utc') + np.arange(num_rows) * step.total_seconds() * u.s
+    mask = np.zeros(num_rows, dtype=bool) if mask is None else mask
+    ephem = Table(masked=True)
+    ephem['targetname'] = ['(2020 SO)'] * num_rows
+    ephem['datetime_str'] = times.strftime("%Y-%b-%d %H:%M")
+    ephem['datetime_jd'] = MaskedColumn(times.jd, unit=u.d)
+    ephem['RA'] = MaskedColumn(ra, unit=u.deg, mask=mask)
+    ephem['DEC'] = MaskedColumn(10.0 + 0.1 * np.arange(num_rows), unit=u.deg)
+    ephem['RA_rate'] = MaskedColumn(np.full(num_rows, 180.0), unit=u.arcsec / u.hour)
+    ephem['DEC_rate'] = MaskedColumn(np.full(num_rows, 36.0), unit=u.arcsec / u.hour)
+    ephem['V'] = MaskedColumn(np.full(num_rows, 20.0), unit=u.mag, mask=mask)
+
+    return ephem
+
+
+class TestInterpolateHorizonsTable:
+
+    @pytest.fixture(autouse=True)
+    def needs_scipy(self):
+        pytest.importorskip('scipy')
+
+    def test_fine_grid(self):
+        ephem = make_ephem(100.0 + 0.5 * np.arange(13))
+
+        interp = interpolate_horizons_table(ephem, datetime(2020, 10, 19), datetime(2020, 10, 19, 2), '1m')
+
+        assert len(interp) == 121
+        assert interp['datetime_str'][0] == '2020-Oct-19 00:00'
+        assert interp['datetime_str'][61] == '2020-Oct-19 01:01'
+        assert interp['datetime_str'][-1] == '2020-Oct-19 02:00'
+        np.testing.assert_allclose(interp['RA'], 100.0 + 0.05 * np.arange(121))
+        assert interp['targetname'][60] == '(2020 SO)'
+
+    def test_ra_wrap(self):
+        ephem = make_ephem((358.0 + 0.5 * np.arange(13)) % 360.0)
+
+        interp = interpolate_horizons_table(ephem, datetime(2020, 10, 19), datetime(2020, 10, 19, 2), '1m')
+
+        expected = (358.0 + 0.05 * np.arange(121)) % 360.0
+        np.testing.assert_allclose(interp['RA'], expected, atol=1e-9)
+
+    def test_ra_wrap_with_masked_row(self):
+        mask = np.arange(13) == 4
+        ephem = make_ephem((358.0 + 0.5 * np.arange(13)) % 360.0, mask=mask)
+
+        interp = interpolate_horizons_table(ephem, datetime(2020, 10, 19), datetime(2020, 10, 19, 2), '1m')
+
+        expected = (358.0 + 0.05 * np.arange(121)) % 360.0
+        masked = interp['RA'].mask
+        # Fine rows nearest the masked coarse row (00:40) are masked, the rest interpolated
+        assert masked[36:45].all()
+        assert masked.sum() == 9
+        np.testing.assert_allclose(interp['RA'][~masked], expected[~masked], atol=1e-9)
+        assert (interp['V'].mask == masked).all()
+
+    def test_gap_is_preserved(self):
+        ephem = make_ephem(100.0 + 0.5 * np.arange(13))
+        ephem.remove_rows([5, 6, 7])
+
+        interp = interpolate_horizons_table(ephem, datetime(2020, 10, 19), datetime(2020, 10, 19, 2), '1m')
+
+        # 00:00-00:40 and 01:20-02:00 inclusive
+        assert len(interp) == 82
+        assert interp['datetime_str'][40] == '2020-Oct-19 00:40'
+        assert interp['datetime_str'][41] == '2020-Oct-19 01:20'
+        np.testing.assert_allclose(interp['RA'][41:], 104.0 + 0.05 * np.arange(41))
+
+    def test_short_table_unchanged(self):
+        ephem = make_ephem([100.0])
+
+        interp = interpolate_horizons_table(ephem, datetime(2020, 10, 19), datetime(2020, 10, 19, 2), '1m')
+
+        assert len(interp) == 1
+        assert interp['RA'][0] == 100.0
+
+    def test_short_table_row_after_end_dropped(self):
+        # Only the extra row queried at end + coarse step is left
+        ephem = make_ephem([100.0], start=datetime(2020, 10, 19, 2, 10))
+
+        interp = interpolate_horizons_table(ephem, datetime(2020, 10, 19), datetime(2020, 10, 19, 2), '1m')
+
+        assert len(interp) == 0
+
+
+class TestStepToTimedelta:
+
+    @pytest.mark.parametrize('step_size, expected', [
+        ('1m', timedelta(minutes=1)),
+        ('10 min', timedelta(minutes=10)),
+        ('2h', timedelta(hours=2)),
+        ('1HOUR', timedelta(hours=1)),
+        ('3d', timedelta(days=3)),
+    ])
+    def test_valid(self, step_size, expected):
+        assert _step_to_timedelta(step_size) == expected
+
+    @pytest.mark.parametrize('step_size', ['5', '1mo', '1y', 'h', ''])
+    def test_unsupported(self, step_size):
+        with pytest.raises(ValueError):
+            _step_to_timedelta(step_size)
+
+
+class TestDetermineHorizonsId:
+
+    lines = ['Ambiguous target name; provide unique id:',
+             '    Record #  Epoch-yr  >MATCH DESIG<  Primary Desig  Name  ',
+             '    --------  --------  -------------  -------------  -------------------------',
+             '    90000030    1786    2P             2P             Encke',
+             '    90000031    1796    2P             2P             Encke',
+             '    90000032    2017    2P             2P             Encke',
+             '    90000033    2020    2P             2P             Encke',
+             '    90000034    2023    2P             2P             Encke',
+             '']
+
+    def test_closest_epoch(self):
+        assert determine_horizons_id(self.lines, now=datetime(2020, 6, 1)) == 90000033
+
+    def test_closest_epoch_future(self):
+        assert determine_horizons_id(self.lines, now=datetime(2023, 11, 1)) == 90000034
+
+    def test_closest_epoch_is_start_of_year(self):
+        # 2021-09 is nearer the start of 2023 than the start of 2020
+        assert determine_horizons_id(self.lines, now=datetime(2021, 9, 1)) == 90000034
+
+    def test_tie_takes_last(self):
+        lines = ['    90000040    2020    2P             2P             Encke',
+                 '    90000041    2020    2P             2P             Encke']
+        assert determine_horizons_id(lines, now=datetime(2020, 6, 1)) == 90000041
+
+    def test_no_matches(self):
+        assert determine_horizons_id(self.lines[:3]) is None
+
+    def test_short_lines_ignored(self):
+        assert determine_horizons_id(['    90000040    2020    2P'], now=datetime(2020, 6, 1)) is None
+
+
+class TestParseHorizonsDatetime:
+
+    def test_minutes(self):
+        assert _parse_horizons_datetime('2020-Oct-19 01:02') == datetime(2020, 10, 19, 1, 2)
+
+    def test_seconds(self):
+        assert _parse_horizons_datetime('2021-Feb-28 23:59:58') == datetime(2021, 2, 28, 23, 59, 58)
+
+    def test_all_months(self):
+        for month in range(1, 13):
+            date = datetime(2020, month, 1, 12, 30)
+            assert _parse_horizons_datetime(date.strftime("%Y-%b-%d %H:%M")) == date
+
+
+class TestQuantitiesForColumns:
+
+    def test_minimal_set(self):
+        assert quantities_for_columns(('RA', 'DEC', 'V', 'hour_angle')) == '1,9,42'
+
+    def test_numeric_sort(self):
+        assert quantities_for_columns(('RSS_3sigma', 'AZ', 'alpha')) == '4,24,38'
+
+    def test_always_present(self):
+        assert quantities_for_columns(('targetname', 'datetime', 'datetime_jd', 'mean_rate')) == ''
+
+    def test_presence_columns(self):
+        assert quantities_for_columns(('RA', 'solar_presence', 'lunar_presence', 'interfering_body')) == '1'
+
+    def test_moon_columns_need_ra_dec(self):
+        assert quantities_for_columns(('V', 'moon_sep', 'moon_phase')) == '1,9'
+
+    def test_unknown_column(self):
+        with pytest.raises(ValueError):
+            quantities_for_columns(('RA', 'not_a_column'))
+
+
+ONEM_LIMITS = (-67.5, 67.5, 30.0)
+POINT4M_LIMITS = (-67.5, 66.9, 15.0)
+DEFAULT_LIMITS = (-180.0, 180.0, 25.0)
+
+
+class TestGetMountlimits:
+
+    @pytest.mark.parametrize('site, expected', [
+        ('V37', ONEM_LIMITS),
+        ('K93', ONEM_LIMITS),
+        ('Q64', ONEM_LIMITS),
+        ('Z17', POINT4M_LIMITS),
+        ('W79', POINT4M_LIMITS),
+        ('L09', POINT4M_LIMITS),
+        ('ELP-DOMA-1M0A', ONEM_LIMITS),
+        ('OGG-CLMA-0M4A', POINT4M_LIMITS),
+        ('TFN-AQWB-0M4A', POINT4M_LIMITS),
+        ('-AQWA', POINT4M_LIMITS),
+        ('v37', ONEM_LIMITS),
+        ('elp-doma-1m0a', ONEM_LIMITS),
+        ('ogg-clma-0m4a', POINT4M_LIMITS),
+        ('OGG-CLMA-2M0A', DEFAULT_LIMITS),
+        ('500', DEFAULT_LIMITS),
+        ('XYZ', DEFAULT_LIMITS),
+        ('-1', DEFAULT_LIMITS),
+    ])
+    def test_limits(self, site, expected):
+        assert get_mountlimits(site) == pytest.approx(expected)
+
+
+class TestSiteConstraints:
+
+    @pytest.mark.parametrize('site, alt_limit, expected', [
+        ('V37', 0, (99, 4.5, True)),
+        ('Z21', 0, (99, 4.5, True)),
+        ('500', 0, (99, 12.0, True)),
+        ('V37', 30, (2.0, 4.5, True)),
+        ('ogg-clma-0m4a', 30, (2.0, 4.5, True)),
+        ('-1', 0, (99, 12.0, False)),
+        ('-253', 30, (2.0, 12.0, False)),
+    ])
+    def test_constraints(self, site, alt_limit, expected):
+        airmass_limit, ha_limit, should_skip_daylight = _site_constraints(site, alt_limit)
+
+        assert airmass_limit == pytest.approx(expected[0])
+        assert ha_limit == pytest.approx(expected[1])
+        assert should_skip_daylight is expected[2]
+
+
+class FakeHorizons:
+    """Stand-in for `astroquery.jplhorizons.Horizons` which returns the table
+    from `make_ephem()` or raises the exception in `errors` for that object id"""
+
+    errors = {}
+    queries = []
+    table = None
+
+    def __init__(self, id, id_type, epochs, location):
+        self.id = id
+        self.id_type = id_type
+        self._session = Session()
+        FakeHorizons.queries.append((id, id_type))
+
+    def ephemerides(self, **kwargs):
+        error = FakeHorizons.errors.get(self.id)
+        if error is not None:
+            raise error
+        if FakeHorizons.table is not None:
+            return FakeHorizons.table.copy()
+        return make_ephem(100.0 + 0.5 * np.arange(13))
+
+
+@pytest.fixture
+def fake_horizons(monkeypatch):
+    FakeHorizons.errors = {}
+    FakeHorizons.queries = []
+    FakeHorizons.table = None
+    monkeypatch.setattr(ephem_subs, 'Horizons', FakeHorizons)
+    return FakeHorizons
+
+
+def http_error(status_code):
+    response = Response()
+    response.status_code = status_code
+    return HTTPError("{} Error".format(status_code), response=response)
+
+
+class TestHorizonsEphem:
+
+    start = datetime(2020, 10, 19)
+    end = datetime(2020, 10, 19, 2)
+
+    def test_table(self, fake_horizons):
+        ephem = horizons_ephem('2020 SO', self.start, self.end, 'V37')
+
+        assert len(ephem) == 13
+        assert ephem['RA_rate'].unit == u.arcsec / u.min
+        assert ephem['mean_rate'][0] == pytest.approx(np.hypot(3.0, 0.6))
+
+    @pytest.mark.parametrize('error', [http_error(429), http_error(500), ReadTimeout('timed out'),
+                                       RequestsConnectionError('no route')])
+    def test_request_errors_return_none(self, fake_horizons, error):
+        fake_horizons.errors['2020 SO'] = error
+
+        assert horizons_ephem('2020 SO', self.start, self.end, 'V37') is None
+
+    def test_ambiguous_object(self, fake_horizons):
+        fake_horizons.errors['2P'] = ValueError('\n'.join(TestDetermineHorizonsId.lines))
+
+        ephem = horizons_ephem('2P', self.start, self.end, 'V37')
+
+        assert len(ephem) == 13
+        assert fake_horizons.queries[-1][1] == 'id'
+
+    @pytest.mark.parametrize('return_as', ['table', 'numpy'])
+    def test_required_moon_columns(self, fake_horizons, return_as):
+        ephem = horizons_ephem('2020 SO', self.start, self.end, 'V37', required_cols=('RA', 'moon_sep'),
+            return_as=return_as)
+
+        assert len(ephem['moon_sep']) == 13
+        assert len(ephem['moon_phase']) == 13
+
+    def test_numpy_masked_values(self, fake_horizons):
+        mask = np.arange(13) == 4
+        ephem = make_ephem(100.0 + 0.5 * np.arange(13), mask=mask)
+        # HORIZONS gives 'n.a.' for every row of e.g. AZ/EL for geocentric
+        # queries, which astroquery types as all-masked integer columns
+        ephem['AZ'] = MaskedColumn(np.zeros(13, dtype=np.int64), unit=u.deg, mask=np.ones(13, dtype=bool))
+        ephem['EL'] = MaskedColumn(np.arange(13, dtype=np.int64), unit=u.deg)
+        fake_horizons.table = ephem
+
+        arrays = horizons_ephem('2020 SO', self.start, self.end, 'V37', return_as='numpy')
+
+        assert arrays['AZ'].dtype == float
+        assert np.isnan(arrays['AZ']).all()
+        assert arrays['EL'].dtype.kind == 'i'
+        np.testing.assert_array_equal(arrays['EL'], np.arange(13))
+        assert np.isnan(arrays['V']).tolist() == mask.tolist()
+        assert np.isnan(arrays['RA']).tolist() == mask.tolist()
+
+    def test_unsupported_step_raises_before_query(self, fake_horizons):
+        with pytest.raises(ValueError):
+            horizons_ephem('2020 SO', self.start, self.end, 'V37', ephem_step_size='5', interp_step='1h')
+
+        assert fake_horizons.queries == []
+
+
+class TestHorizonsEphemMany:
+
+    def test_failed_object_does_not_abort_batch(self, fake_horizons):
+        fake_horizons.errors['bad'] = http_error(429)
+
+        ephems = horizons_ephem_many(['2020 SO', 'bad'], datetime(2020, 10, 19), datetime(2020, 10, 19, 2), 'V37')
+
+        assert sorted(ephems) == ['2020 SO', 'bad']
+        assert len(ephems['2020 SO']) == 13
+        assert ephems['bad'] is None
+
+
+class TestCachedEphemerides:
+
+    start = datetime(2020, 10, 19)
+    end = datetime(2020, 10, 19, 2)
+    ttl = timedelta(hours=1)
+
+    @pytest.fixture(autouse=True)
+    def cache_dir(self, monkeypatch, tmp_path):
+        cache_dir = tmp_path / 'cache'
+        monkeypatch.setattr(ephem_subs, 'CACHE_DIR', str(cache_dir))
+        return cache_dir
+
+    def test_cache_hit(self, fake_horizons, cache_dir):
+        first = horizons_ephem('2020 SO', self.start, self.end, 'V37', cache_ttl=self.ttl)
+        second = horizons_ephem('2020 SO', self.start, self.end, 'V37', cache_ttl=self.ttl)
+
+        assert len(fake_horizons.queries) == 1
+        assert len(list(cache_dir.iterdir())) == 1
+        np.testing.assert_allclose(second['RA'], first['RA'])
+
+    def test_cache_hit_matches_miss(self, fake_horizons):
+        mask = np.arange(13) == 4
+        fake_horizons.table = make_ephem(100.0 + 0.5 * np.arange(13), mask=mask)
+        miss = horizons_ephem('2020 SO', self.start, self.end, 'V37', cache_ttl=self.ttl)
+        hit = horizons_ephem('2020 SO', self.start, self.end, 'V37', cache_ttl=self.ttl)
+
+        assert len(fake_horizons.queries) == 1
+        assert hit.colnames == miss.colnames
+        for name in miss.colnames:
+            assert type(hit[name]) is type(miss[name]), name
+            assert getattr(hit[name], 'unit', None) == getattr(miss[name], 'unit', None), name
+            assert (np.asarray(hit[name].mask) == np.asarray(miss[name].mask)).all(), name
+        assert hit['V'].mask[4]
+        assert not hit['DEC'].mask.any()
+        np.testing.assert_allclose(hit['DEC'].filled(), miss['DEC'].filled())
+
+    def test_corrupt_cache_file_is_a_miss(self, fake_horizons, cache_dir):
+        horizons_ephem('2020 SO', self.start, self.end, 'V37', cache_ttl=self.ttl)
+        cache_file, = cache_dir.iterdir()
+        cache_file.write_text('# %ECSV 1.0\nnot a table\n')
+
+        ephem = horizons_ephem('2020 SO', self.start, self.end, 'V37', cache_ttl=self.ttl)
+
+        assert len(ephem) == 13
+        assert len(fake_horizons.queries) == 2
+        # The bad file was replaced by the fresh response
+        assert len(Table.read(str(cache_file), format='ascii.ecsv')) == 13
+
+    def test_unwritable_cache_dir(self, fake_horizons, cache_dir):
+        # A file where the cache directory should be makes os.makedirs() fail
+        cache_dir.write_text('')
+
+        ephem = horizons_ephem('2020 SO', self.start, self.end, 'V37', cache_ttl=self.ttl)
+
+        assert len(ephem) == 13
+
+    def test_failed_write_leaves_no_temporary_file(self, fake_horizons, cache_dir, monkeypatch):
+        def failing_replace(src, dst):
+            raise OSError('disk full')
+        monkeypatch.setattr(ephem_subs.os, 'replace', failing_replace)
+
+        ephem = horizons_ephem('2020 SO', self.start, self.end, 'V37', cache_ttl=self.ttl)
+
+        assert len(ephem) == 13
+        assert list(cache_dir.iterdir()) == []
+
+    def test_horizons_id_is_cached(self, fake_horizons):
+        fake_horizons.errors['2P'] = ValueError('\n'.join(TestDetermineHorizonsId.lines))
+        horizons_ephem('2P', self.start, self.end, 'V37', cache_ttl=self.ttl)
+        queries = list(fake_horizons.queries)
+
+        # A different time range isn't in the ephemeris cache but the id is
+        ephem = horizons_ephem('2P', self.start, self.end + timedelta(hours=1), 'V37', cache_ttl=self.ttl)
+
+        assert len(ephem) == 13
+        assert queries[0] == ('2P', 'smallbody')
+        assert queries[1][1] == 'id'
+        assert fake_horizons.queries[2:] == [queries[1]]
+
+    def test_ambiguous_object_cache_hit(self, fake_horizons):
+        fake_horizons.errors['2P'] = ValueError('\n'.join(TestDetermineHorizonsId.lines))
+        horizons_ephem('2P', self.start, self.end, 'V37', cache_ttl=self.ttl)
+
+        ephem = horizons_ephem('2P', self.start, self.end, 'V37', cache_ttl=self.ttl)
+
+        assert len(ephem) == 13
+        assert len(fake_horizons.queries) == 2
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from astropy.time import Time
+
+from horizons_wrapper._moon import moon_sep_phase
+from horizons_wrapper.ephem_subs import MOON_KERNEL_MIN_ROWS, calc_moon_sep_phase, convert_horizons_table
+from .test_ephem_subs import make_ephem
+
+
+class TestMoonSepPhase:
+
+    # Dates past the end of the leap second table are flagged as dubious by ERFA
+    @pytest.mark.filterwarnings('ignore::erfa.ErfaWarning')
+    def test_matches_astropy(self):
+        # Random times over 1980-2060 and positions uniform over the sky
+        rng = np.random.default_rng(42)
+        num_points = 500
+        jd = Time(datetime(1980, 1, 1)).jd + rng.uniform(0.0, 80 * 365.25, num_points)
+        ra = rng.uniform(0.0, 360.0, num_points)
+        dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, num_points)))
+
+        moon_seps, moon_phases = moon_sep_phase(jd, np.radians(ra), np.radians(dec))
+        expected_seps, expected_phases = calc_moon_sep_phase(Time(jd, format='jd', scale='utc'), ra, dec)
+
+        np.testing.assert_allclose(moon_seps, expected_seps, atol=2.0 / 60.0)
+        np.testing.assert_allclose(moon_phases, expected_phases, atol=5e-4)
+
+    def test_scalar(self):
+        jd = Time(datetime(2020, 10, 19)).jd
+
+        moon_sep, moon_phase = moon_sep_phase(jd, np.radians(100.0), np.radians(10.0))
+        expected_sep, expected_phase = calc_moon_sep_phase(Time(jd, format='jd'), 100.0, 10.0)
+
+        assert moon_sep == pytest.approx(expected_sep, abs=2.0 / 60.0)
+        assert moon_phase == pytest.approx(expected_phase, abs=5e-4)
+
+    def test_topocentric_parallax(self):
+        # The Moon's parallax is up to ~1 deg so the topocentric separation differs
+        jd = Time(datetime(2020, 10, 19)).jd + np.arange(24) / 24.0
+        ra = np.radians(np.full(24, 100.0))
+        dec = np.radians(np.full(24, 10.0))
+
+        geo_seps, geo_phases = moon_sep_phase(jd, ra, dec)
+        topo_seps, topo_phases = moon_sep_phase(jd, ra, dec, lon=np.radians(-116.9), lat=np.radians(33.4))
+
+        assert 0.1 < np.max(np.abs(topo_seps - geo_seps)) < 1.1
+        np.testing.assert_allclose(topo_phases, geo_phases)
+
+
+class TestConvertHorizonsTableMoon:
+
+    @pytest.mark.parametrize('num_rows', [MOON_KERNEL_MIN_ROWS, MOON_KERNEL_MIN_ROWS + 1])
+    def test_either_side_of_kernel_switch(self, num_rows):
+        ephem = convert_horizons_table(make_ephem(100.0 + 0.5 * np.arange(num_rows)), include_moon=True)
+
+        expected_seps, expected_phases = calc_moon_sep_phase(Time(ephem['datetime_jd'], format='jd'),
+            np.asarray(ephem['RA']), np.asarray(ephem['DEC']))
+        np.testing.assert_allclose(ephem['moon_sep'], expected_seps, atol=2.0 / 60.0)
+        np.testing.assert_allclose(ephem['moon_phase'], expected_phases, atol=5e-4)